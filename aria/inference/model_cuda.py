@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 
 from torch.nn import functional as F
-from aria.model import ModelConfig
+from aria.model import ModelConfig, _fill_tied_lm_head
 
 
 class KVCache(nn.Module):
@@ -206,12 +206,19 @@ class TransformerLM(nn.Module):
         self.lm_head = nn.Linear(
             model_config.d_model, model_config.vocab_size, bias=False
         )
+        if model_config.tie_embeddings:
+            self.lm_head.weight = self.model.tok_embeddings.weight
 
         if model_config.emb_size is not None:
             self.embedding_adapter = nn.Linear(
                 model_config.emb_size, model_config.d_model, bias=False
             )
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Tied training checkpoints only store model.tok_embeddings.weight
+        _fill_tied_lm_head(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(
         self,
         idxs: torch.Tensor,
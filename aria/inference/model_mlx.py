@@ -226,9 +226,10 @@ class TransformerLM(nn.Module):
         self.model_config = model_config
         self.max_seq_len = model_config.max_seq_len
         self.model = Transformer(model_config)  # Implement
-        self.lm_head = nn.Linear(
-            model_config.d_model, model_config.vocab_size, bias=False
-        )
+        if not model_config.tie_embeddings:
+            self.lm_head = nn.Linear(
+                model_config.d_model, model_config.vocab_size, bias=False
+            )
 
         if model_config.emb_size is not None:
             self.embedding_adapter = nn.Linear(
@@ -250,7 +251,11 @@ class TransformerLM(nn.Module):
             offset=offset,
             pad_idxs=pad_idxs,
         )
-        logits = self.lm_head(hidden_states)
+        if self.model_config.tie_embeddings:
+            # Tied checkpoints only store model.tok_embeddings.weight
+            logits = self.model.tok_embeddings.as_linear(hidden_states)
+        else:
+            logits = self.lm_head(hidden_states)
 
         return logits
 
@@ -1,13 +1,14 @@
 """Training model implementation."""
 
 from dataclasses import dataclass
-from typing import Optional
+from typing import Literal, Optional
 
 import torch
 import torch.utils.checkpoint
 
 from torch import nn as nn
 from torch.nn import functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
 
 @dataclass
@@ -23,11 +24,24 @@ class ModelConfig:
     vocab_size: Optional[int] = None
     class_size: Optional[int] = None
     emb_size: Optional[dict] = None
+    checkpoint_policy: Optional[Literal["full", "selective", "none"]] = None
+    compile: bool = False
+    tie_embeddings: bool = False
+    compute_dtype: Optional[str] = None
+
+    def __post_init__(self):
+        # Defaults to full-layer checkpointing if grad_checkpoint is set
+        if self.checkpoint_policy is None:
+            self.checkpoint_policy = "full" if self.grad_checkpoint else "none"
 
     def set_vocab_size(self, vocab_size: int):
         self.vocab_size = vocab_size
 
 
+# Excludes the math backend, which materializes the full attention matrix
+_SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
+
 class FusedEncoderBlock(nn.Module):
     def __init__(self, model_config: ModelConfig, resid_dropout: float = 0.0):
         super().__init__()
@@ -49,15 +63,10 @@ class FusedEncoderBlock(nn.Module):
             bias=False,
         )
 
-        # FF Layer
-        self.ff_gate_proj = nn.Linear(
+        # FF Layer - gate and up projections are fused into a single matmul
+        self.ff_gate_up_proj = nn.Linear(
             in_features=model_config.d_model,
-            out_features=model_config.d_model * model_config.ff_mult,
-            bias=False,
-        )
-        self.ff_up_proj = nn.Linear(
-            in_features=model_config.d_model,
-            out_features=model_config.d_model * model_config.ff_mult,
+            out_features=2 * model_config.d_model * model_config.ff_mult,
             bias=False,
         )
         self.ff_down_proj = nn.Linear(
@@ -70,54 +79,104 @@ class FusedEncoderBlock(nn.Module):
         self.norm1 = nn.LayerNorm(model_config.d_model)
         self.norm2 = nn.LayerNorm(model_config.d_model)
 
-    def forward(self, x: torch.Tensor, freqs_cis: torch.Tensor):
-        att_out = self._att_block(self.norm1(x), freqs_cis)
-        x = x + F.dropout(att_out, p=self.resid_dropout, training=self.training)
+        # Checkpoints store ff_gate_proj and ff_up_proj separately
+        self._register_state_dict_hook(_split_ff_gate_up_proj)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        gate_key = prefix + "ff_gate_proj.weight"
+        up_key = prefix + "ff_up_proj.weight"
+        if gate_key in state_dict and up_key in state_dict:
+            state_dict[prefix + "ff_gate_up_proj.weight"] = torch.cat(
+                [state_dict.pop(gate_key), state_dict.pop(up_key)], dim=0
+            )
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        cos_sin: tuple[torch.Tensor, torch.Tensor],
+        varlen_idxs: tuple | None = None,
+    ):
+        att_out = self._att_block(self.norm1(x), cos_sin, varlen_idxs)
+        h, x = fused_add_layer_norm(
+            x,
+            self._resid_dropout(att_out),
+            self.norm2.weight,
+            self.norm2.bias,
+            self.norm2.eps,
+        )
 
-        ff_out = self._ff_block(self.norm2(x))
-        x = x + F.dropout(ff_out, p=self.resid_dropout, training=self.training)
+        ff_out = self._ff_block(h)
+        x = x + self._resid_dropout(ff_out)
 
         return x
 
-    def _att_block(self, x: torch.Tensor, freqs_cis: torch.Tensor):
-        batch_size, seq_len, _ = x.shape
-        mixed_qkv = self.mixed_qkv(x)
-        xq, xk, xv = mixed_qkv.chunk(3, -1)
-
-        # Reshape for rotary embeddings
-        # Need contiguous for q, k since in-place RoPE cannot be applied on a view
-        xq = xq.reshape(
-            batch_size, seq_len, self.n_heads, self.d_head
-        ).contiguous()
-        xk = xk.reshape(
-            batch_size, seq_len, self.n_heads, self.d_head
-        ).contiguous()
-        xv = xv.view(batch_size, seq_len, self.n_heads, self.d_head)
+    def _resid_dropout(self, x: torch.Tensor):
+        # Avoids launching a no-op dropout kernel for layers with p=0
+        if self.resid_dropout > 0.0:
+            return F.dropout(x, p=self.resid_dropout, training=self.training)
+        else:
+            return x
+
+    def _att_block(
+        self,
+        x: torch.Tensor,
+        cos_sin: tuple[torch.Tensor, torch.Tensor],
+        varlen_idxs: tuple | None = None,
+    ):
+        # Linear inputs are flattened to 2D so that F.linear dispatches to addmm
+        batch_size, seq_len, d_model = x.shape
+        mixed_qkv = self.mixed_qkv(x.reshape(-1, d_model)).view(
+            batch_size, seq_len, 3, self.n_heads, self.d_head
+        )
+        xq, xk, xv = mixed_qkv.unbind(dim=2)
 
         # apply_rotary_post_emb expects: (b_sz, s_len, n_head, d_head)
-        xq = apply_rotary_emb(xq, freqs_cis)
-        xk = apply_rotary_emb(xk, freqs_cis)
+        xq = apply_rotary_emb(xq, *cos_sin)
+        xk = apply_rotary_emb(xk, *cos_sin)
+
+        if varlen_idxs is not None:
+            # Only attends over (and computes) non-padding positions
+            out = _varlen_causal_attention(xq, xk, xv, *varlen_idxs)
+            out = out.view(batch_size * seq_len, self.n_heads * self.d_head)
+
+            return self.att_proj_linear(out).view(batch_size, seq_len, -1)
+
         xq, xk, xv = map(lambda t: t.transpose(1, 2), (xq, xk, xv))
 
         # scaled_dot_product_attention expects: (b_sz, n_head, s_len, d_head)
-        att = F.scaled_dot_product_attention(
-            query=xq,
-            key=xk,
-            value=xv,
-            is_causal=True,
-        )
+        with sdpa_kernel(_SDPA_BACKENDS):
+            att = F.scaled_dot_product_attention(
+                query=xq,
+                key=xk,
+                value=xv,
+                is_causal=True,
+            )
 
-        # Reshape for out: (b_sz, s_len, n_head, d_head)
-        out = att.transpose(1, 2).contiguous()
-        out = out.view(batch_size, seq_len, self.n_heads * self.d_head)
+        # Reshape for out: (b_sz, s_len, n_head, d_head), only copies if needed
+        out = att.transpose(1, 2).reshape(
+            batch_size * seq_len, self.n_heads * self.d_head
+        )
 
-        return self.att_proj_linear(out)
+        return self.att_proj_linear(out).view(batch_size, seq_len, -1)
 
     def _ff_block(self, x: torch.Tensor):
+        batch_size, seq_len, d_model = x.shape
+        gate, up = self.ff_gate_up_proj(x.reshape(-1, d_model)).chunk(2, dim=-1)
+        out = self.ff_down_proj(F.silu(gate) * up)
+
+        return out.view(batch_size, seq_len, d_model)
 
-        return self.ff_down_proj(
-            F.silu(self.ff_gate_proj(x)) * self.ff_up_proj(x)
-        )
+
+def _split_ff_gate_up_proj(module, state_dict, prefix, local_metadata):
+    # Each half is copied to host memory so that it owns its storage
+    # (safetensors rejects partial views), without allocating on the device
+    gate, up = state_dict.pop(prefix + "ff_gate_up_proj.weight").chunk(2, dim=0)
+    state_dict[prefix + "ff_gate_proj.weight"] = gate.to("cpu", copy=True)
+    state_dict[prefix + "ff_up_proj.weight"] = up.to("cpu", copy=True)
+
+    return state_dict
 
 
 class Transformer(nn.Module):
@@ -130,7 +189,22 @@ class Transformer(nn.Module):
     def __init__(self, model_config: ModelConfig):
         super().__init__()
         self.model_config = model_config
-        self.freqs_cis = None
+        # Residual stream dtype under autocast, e.g., "bfloat16" (ignored
+        # when autocast is not active)
+        self.compute_dtype = (
+            getattr(torch, model_config.compute_dtype)
+            if model_config.compute_dtype is not None
+            else None
+        )
+        self.register_buffer(
+            "freqs_cis",
+            precompute_freqs_cis(
+                seq_len=model_config.max_seq_len,
+                n_elem=model_config.d_model // model_config.n_heads,
+                base=500000,
+            ),
+            persistent=False,
+        )
 
         self.tok_embeddings = nn.Embedding(
             num_embeddings=model_config.vocab_size,
@@ -152,59 +226,141 @@ class Transformer(nn.Module):
                 FusedEncoderBlock(model_config, resid_dropout=layer_dropout)
             )
 
+        if model_config.compile:
+            # Compiled in-place so that state_dict keys are unchanged. Note
+            # that fullgraph=True does not support the attention_mask path.
+            self.compile(mode="max-autotune", fullgraph=True, dynamic=False)
+
+    def _apply(self, fn, recurse=True):
+        # Keeps the RoPE table in float32 when the module is cast, e.g., to
+        # bf16, only its device follows the rest of the module
+        freqs_cis = self.freqs_cis
+        super()._apply(fn, recurse)
+        self.freqs_cis = freqs_cis.to(self.freqs_cis.device)
+
+        return self
+
     def forward(
         self,
         src: torch.Tensor,
         emb: torch.Tensor | None = None,
+        attention_mask: torch.Tensor | None = None,
+        apply_out_norm: bool = True,
     ):
         """Perform a forward pass through the transformer.
 
         Args:
             src (torch.Tensor): Input tensor of token indices with shape (batch_size, seq_len).
             emb (Optional[torch.Tensor]): Optional extra embedding with shape (batch_size, emb_dim).
+            attention_mask (Optional[torch.Tensor]): Optional bool tensor with shape (batch_size, seq_len), False at
+                padding positions of src. If provided, attention skips padding via flash-attn's varlen kernel.
+            apply_out_norm (bool): If False, out_layer_norm is left to the caller so that it can be fused with the head.
 
         Returns:
             torch.Tensor: Output tensor with shape (batch_size, seq_len, d_model).
         """
 
         hidden_states = self.tok_embeddings(src)
+        if self.compute_dtype is not None and torch.is_autocast_enabled(
+            hidden_states.device.type
+        ):
+            # Only under autocast, otherwise the linears see a dtype mismatch
+            hidden_states = hidden_states.to(self.compute_dtype)
 
         if emb is not None:
-            emb = emb[:, None, :]
-            hidden_states = torch.cat([emb, hidden_states[:, :-1, :]], dim=1)
-
-        if self.freqs_cis is None:
-            self.freqs_cis = precompute_freqs_cis(
-                seq_len=self.model_config.max_seq_len,
-                n_elem=self.model_config.d_model // self.model_config.n_heads,
-                base=500000,
-            ).to(src.device)
+            # Shift right by one, writing emb into the first position
+            shifted = torch.empty_like(hidden_states)
+            shifted[:, 0, :] = emb
+            shifted[:, 1:, :] = hidden_states[:, :-1, :]
+            hidden_states = shifted
+
+        # Sliced once and shared by every layer: (1, s_len, 1, d_head // 2).
+        # RoPE math stays in float32 even if the module was cast to bf16/fp16.
         freqs_cis = self.freqs_cis[: src.shape[1]]
+        cos_sin = (
+            freqs_cis[None, :, None, :, 0].contiguous(),
+            freqs_cis[None, :, None, :, 1].contiguous(),
+        )
 
-        if self.model_config.grad_checkpoint is True and self.training:
-            for layer in self.encode_layers:
-
-                def create_custom_forward(module):
-                    def custom_forward(*args):
-                        return module(*args)
-
-                    return custom_forward
+        if attention_mask is not None:
+            if emb is not None:
+                # Account for emb being prepended to the sequence
+                attention_mask = F.pad(
+                    attention_mask[:, :-1], (1, 0), value=True
+                )
+            varlen_idxs = get_varlen_idxs(attention_mask)
+        else:
+            varlen_idxs = None
 
+        checkpoint_policy = self.model_config.checkpoint_policy
+        if checkpoint_policy == "full" and self.training:
+            for layer in self.encode_layers:
                 hidden_states = torch.utils.checkpoint.checkpoint(
-                    create_custom_forward(layer),
+                    layer,
                     hidden_states,
-                    freqs_cis,
+                    cos_sin,
+                    varlen_idxs,
                     preserve_rng_state=True,
-                    use_reentrant=True,
+                    use_reentrant=False,
+                )
+        elif checkpoint_policy == "selective" and self.training:
+            for layer in self.encode_layers:
+                hidden_states = torch.utils.checkpoint.checkpoint(
+                    layer,
+                    hidden_states,
+                    cos_sin,
+                    varlen_idxs,
+                    use_reentrant=False,
+                    context_fn=_selective_checkpoint_contexts,
                 )
         else:
             for layer in self.encode_layers:
-                hidden_states = layer(hidden_states, freqs_cis=freqs_cis)
+                hidden_states = layer(
+                    hidden_states,
+                    cos_sin=cos_sin,
+                    varlen_idxs=varlen_idxs,
+                )
 
-        return self.out_layer_norm(hidden_states)
+        if apply_out_norm:
+            return self.out_layer_norm(hidden_states)
+        else:
+            return hidden_states
+
+    def norm_and_project(self, hidden: torch.Tensor, weight: torch.Tensor):
+        """Applies out_layer_norm and a bias-free head with the given weight."""
 
+        return fused_layer_norm_linear(
+            hidden,
+            self.out_layer_norm.weight,
+            self.out_layer_norm.bias,
+            self.out_layer_norm.eps,
+            weight,
+        )
 
-class TransformerLM(nn.Module):
+
+class QuantizeMixin:
+    """Adds in-place int8 weight-only quantization to the model classes."""
+
+    def quantize_(self, dtype: str = "int8_weight_only"):
+        """Quantize the weights of all linear layers in-place (inference only).
+
+        Args:
+            dtype (str): Quantization scheme, only "int8_weight_only" is supported.
+        """
+
+        assert self.training is False, "Quantization is only for inference"
+        assert dtype == "int8_weight_only", f"Unsupported dtype: {dtype}"
+        try:
+            from torchao.quantization import Int8WeightOnlyConfig, quantize_
+        except ImportError as e:
+            raise ImportError(
+                "Please install torchao in order to quantize the model"
+            ) from e
+
+        quantize_(self, Int8WeightOnlyConfig())
+
+
+class TransformerLM(QuantizeMixin, nn.Module):
     """Transformer decoder with a language modeling head.
 
     Args:
@@ -220,27 +376,41 @@ class TransformerLM(nn.Module):
         self.lm_head = nn.Linear(
             model_config.d_model, model_config.vocab_size, bias=False
         )
+        if model_config.tie_embeddings:
+            self.lm_head.weight = self.model.tok_embeddings.weight
+            # nn.Embedding inits with std=1, too large for the output head
+            nn.init.normal_(self.lm_head.weight, std=model_config.d_model**-0.5)
+            # Tied weights are only stored under model.tok_embeddings.weight
+            self._register_state_dict_hook(_drop_tied_lm_head)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _fill_tied_lm_head(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(
         self,
         src: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
     ):
         """Compute language modeling logits.
 
         Args:
             src (torch.Tensor): Input tensor of token indices with shape (batch_size, seq_len).
+            attention_mask (Optional[torch.Tensor]): Optional bool padding mask with shape (batch_size, seq_len).
 
         Returns:
             torch.Tensor: Logits with shape (batch_size, seq_len, vocab_size).
         """
 
-        hidden = self.model(src)
-        logits = self.lm_head(hidden)
+        hidden = self.model(
+            src, attention_mask=attention_mask, apply_out_norm=False
+        )
+        logits = self.model.norm_and_project(hidden, self.lm_head.weight)
 
         return logits
 
 
-class TransformerCL(nn.Module):
+class TransformerCL(QuantizeMixin, nn.Module):
     """Transformer decoder with a classification head.
 
     Args:
@@ -270,13 +440,13 @@ class TransformerCL(nn.Module):
             torch.Tensor: Classification logits with shape (batch_size, seq_len, class_size).
         """
 
-        hidden = self.model(src)
-        logits = self.class_head(hidden)
+        hidden = self.model(src, apply_out_norm=False)
+        logits = self.model.norm_and_project(hidden, self.class_head.weight)
 
         return logits
 
 
-class TransformerLM_CND(nn.Module):
+class TransformerLM_CND(QuantizeMixin, nn.Module):
     """Transformer decoder with a language modeling head and optional conditioning.
 
     Args:
@@ -292,20 +462,32 @@ class TransformerLM_CND(nn.Module):
         self.lm_head = nn.Linear(
             model_config.d_model, model_config.vocab_size, bias=False
         )
+        if model_config.tie_embeddings:
+            self.lm_head.weight = self.model.tok_embeddings.weight
+            # nn.Embedding inits with std=1, too large for the output head
+            nn.init.normal_(self.lm_head.weight, std=model_config.d_model**-0.5)
+            # Tied weights are only stored under model.tok_embeddings.weight
+            self._register_state_dict_hook(_drop_tied_lm_head)
         self.embedding_adapter = nn.Linear(
             model_config.emb_size, model_config.d_model, bias=False
         )
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _fill_tied_lm_head(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(
         self,
         src: torch.Tensor,
         emb: torch.Tensor | None = None,
+        attention_mask: torch.Tensor | None = None,
     ):
         """Compute language modeling logits with optional conditioning.
 
         Args:
             src (torch.Tensor): Input tensor of token indices with shape (batch_size, seq_len).
             emb (Optional[torch.Tensor]): Optional conditioning embedding with shape (batch_size, emb_size).
+            attention_mask (Optional[torch.Tensor]): Optional bool padding mask with shape (batch_size, seq_len).
 
         Returns:
             torch.Tensor: Logits with shape (batch_size, seq_len, vocab_size).
@@ -317,28 +499,24 @@ class TransformerLM_CND(nn.Module):
             # Embedding is prepended to sequence via the adapter. We slice the
             # logits so that the logits format still matches src.
             emb = self.embedding_adapter(emb)
-            hidden = self.model(src, emb)
-            logits = self.lm_head(hidden)
+            hidden = self.model(
+                src, emb, attention_mask=attention_mask, apply_out_norm=False
+            )
+            logits = self.model.norm_and_project(
+                hidden[:, 1:, :], self.lm_head.weight
+            )
 
-            return logits[:, 1:, :]
+            return logits
         else:
-            # Needed for torch dpp error
-            dummy_input = torch.zeros(
-                src.size(0),
-                self.embedding_adapter.in_features,
-                device=src.device,
+            hidden = self.model(
+                src, None, attention_mask=attention_mask, apply_out_norm=False
             )
-            dummy_output = self.embedding_adapter(dummy_input)
-            dummy_loss = dummy_output.sum() * 0.0
-
-            hidden = self.model(src, None)
-            logits = self.lm_head(hidden)
-            logits = logits + dummy_loss
+            logits = self.model.norm_and_project(hidden, self.lm_head.weight)
 
             return logits
 
 
-class TransformerEMB(nn.Module):
+class TransformerEMB(QuantizeMixin, nn.Module):
     """Transformer decoder with an embedding head.
 
     Args:
@@ -368,42 +546,167 @@ class TransformerEMB(nn.Module):
             torch.Tensor: Output embeddings with shape (batch_size, seq_len, emb_size).
         """
 
-        hidden = self.model(src)
-        emb = self.emb_head(hidden)
+        hidden = self.model(src, apply_out_norm=False)
+        emb = self.model.norm_and_project(hidden, self.emb_head.weight)
 
         return emb
 
 
+def _drop_tied_lm_head(module, state_dict, prefix, local_metadata):
+    state_dict.pop(prefix + "lm_head.weight", None)
+
+    return state_dict
+
+
+def _fill_tied_lm_head(module: nn.Module, state_dict: dict, prefix: str):
+    # Tied weights may be saved under either name (e.g., by safetensors)
+    head_key = prefix + "lm_head.weight"
+    emb_key = prefix + "model.tok_embeddings.weight"
+    if module.lm_head.weight is module.model.tok_embeddings.weight:
+        if head_key not in state_dict and emb_key in state_dict:
+            state_dict[head_key] = state_dict[emb_key]
+        elif emb_key not in state_dict and head_key in state_dict:
+            state_dict[emb_key] = state_dict[head_key]
+
+
+def get_varlen_idxs(attention_mask: torch.Tensor):
+    """
+    Returns (token_idxs, cu_seqlens, max_seqlen) for _varlen_causal_attention.
+    attention_mask shape (b_sz, s_len) and is False at padding positions.
+    """
+    seq_lens = attention_mask.sum(dim=-1, dtype=torch.int32)
+    cu_seqlens = F.pad(seq_lens.cumsum(dim=0, dtype=torch.int32), (1, 0))
+    token_idxs = attention_mask.flatten().nonzero().flatten()
+
+    return token_idxs, cu_seqlens, int(seq_lens.max())
+
+
+def _varlen_causal_attention(
+    xq: torch.Tensor,
+    xk: torch.Tensor,
+    xv: torch.Tensor,
+    token_idxs: torch.Tensor,
+    cu_seqlens: torch.Tensor,
+    max_seqlen: int,
+):
+    """
+    Causal attention over the non-padding positions of each sequence.
+    xq, xk, xv shape (b_sz, s_len, n_head, d_head). Padding positions of
+    the output are zero.
+    """
+    try:
+        from flash_attn import flash_attn_varlen_func
+    except ImportError as e:
+        raise ImportError(
+            "Please install flash-attn in order to use attention_mask"
+        ) from e
+
+    batch_size, seq_len, n_heads, d_head = xq.shape
+    xq, xk, xv = (
+        t.reshape(batch_size * seq_len, n_heads, d_head).index_select(
+            0, token_idxs
+        )
+        for t in (xq, xk, xv)
+    )
+    att = flash_attn_varlen_func(
+        xq,
+        xk,
+        xv,
+        cu_seqlens_q=cu_seqlens,
+        cu_seqlens_k=cu_seqlens,
+        max_seqlen_q=max_seqlen,
+        max_seqlen_k=max_seqlen,
+        causal=True,
+    )
+    out = att.new_zeros(batch_size * seq_len, n_heads, d_head)
+    out = out.index_copy(0, token_idxs, att)
+
+    return out.view(batch_size, seq_len, n_heads, d_head)
+
+
+# Outputs of these ops are kept under selective checkpointing, all other
+# activations (norms, activations, residuals, etc.) are recomputed
+_SELECTIVE_CHECKPOINT_SAVE_OPS = {
+    torch.ops.aten.mm.default,
+    torch.ops.aten.addmm.default,
+    torch.ops.aten._scaled_dot_product_flash_attention.default,
+    torch.ops.aten._scaled_dot_product_efficient_attention.default,
+}
+
+
+def _selective_checkpoint_contexts():
+    # Requires torch>=2.4
+    from torch.utils.checkpoint import (
+        CheckpointPolicy,
+        create_selective_checkpoint_contexts,
+    )
+
+    def _policy_fn(ctx, op, *args, **kwargs):
+        if op in _SELECTIVE_CHECKPOINT_SAVE_OPS:
+            return CheckpointPolicy.MUST_SAVE
+        else:
+            return CheckpointPolicy.PREFER_RECOMPUTE
+
+    return create_selective_checkpoint_contexts(_policy_fn)
+
+
 def precompute_freqs_cis(
     seq_len: int,
     n_elem: int,
     base: int = 500000,
 ):
-    freqs = 1.0 / (
-        base ** (torch.arange(0, n_elem, 2)[: (n_elem // 2)].float() / n_elem)
-    )
-    t = torch.arange(seq_len, device=freqs.device)
+    exponents = torch.arange(0, n_elem, 2, dtype=torch.float32)
+    freqs = 1.0 / (base ** (exponents[: (n_elem // 2)] / n_elem))
+    t = torch.arange(seq_len, dtype=torch.float32)
     freqs = torch.outer(t, freqs)
-    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)
-    cache = torch.stack([freqs_cis.real, freqs_cis.imag], dim=-1)
+    cache = torch.stack([freqs.cos(), freqs.sin()], dim=-1)
 
     return cache
 
 
-@torch.jit.script
-def apply_rotary_emb(x: torch.Tensor, freqs_cis: torch.Tensor) -> torch.Tensor:
+@torch.compile(dynamic=True, fullgraph=True)
+def fused_add_layer_norm(
+    residual: torch.Tensor,
+    update: torch.Tensor,
+    weight: torch.Tensor,
+    bias: torch.Tensor,
+    eps: float,
+):
+    """
+    Residual add followed by LayerNorm, compiled into a single pass over
+    the residual stream. Returns (normed, residual + update).
+    """
+    residual = residual + update
+    normed = F.layer_norm(residual, weight.shape, weight, bias, eps)
+    return normed, residual
+
+
+@torch.compile(dynamic=True, fullgraph=True)
+def fused_layer_norm_linear(
+    x: torch.Tensor,
+    norm_weight: torch.Tensor,
+    norm_bias: torch.Tensor,
+    eps: float,
+    weight: torch.Tensor,
+):
+    """
+    LayerNorm followed by a bias-free linear layer, compiled together so the
+    normalized hidden state does not round-trip through memory.
+    """
+    x = F.layer_norm(x, norm_weight.shape, norm_weight, norm_bias, eps)
+    return F.linear(x, weight)
+
+
+@torch.compile(dynamic=True, fullgraph=True)
+def apply_rotary_emb(
+    x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor
+) -> torch.Tensor:
     """
-    In-place RoPE. Credits to Katherine Crowson:
+    Out-of-place RoPE, so x may be a strided view. Compiled so that the
+    rotation runs as a single fused kernel in the dtype of x.
     x shape (b_sz, s_len, n_head, d_head).
-    freqs_cis shape (s_len, d_head // 2, 2) and is float32.
+    cos, sin shape (1, s_len, 1, d_head // 2) and are float32.
     """
-    x_float = x.float()
-    freqs_cis = freqs_cis.detach()
-    d = x_float.shape[-1] // 2
-    cos = freqs_cis[..., 0][None, :, None]
-    sin = freqs_cis[..., 1][None, :, None]
-    x1, x2 = x_float[..., :d], x_float[..., d : d * 2]
-    tmp = x1.clone()
-    x1.mul_(cos).addcmul_(x2, sin, value=-1)
-    x2.mul_(cos).addcmul_(tmp, sin, value=1)
-    return x.copy_(x_float)
+    x1, x2 = x.chunk(2, dim=-1)
+    out = torch.cat([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1)
+    return out.type_as(x)
@@ -219,7 +219,13 @@ def _load_inference_model_torch(
     model = TransformerLM(model_config)
 
     state_dict = load_file(filename=checkpoint_path)
-    model.load_state_dict(state_dict=state_dict, strict=strict)
+    missing_keys, _ = model.load_state_dict(
+        state_dict=state_dict, strict=strict
+    )
+    assert "lm_head.weight" not in missing_keys, (
+        "Checkpoint is missing lm_head.weight. If it was trained with tied "
+        "embeddings, set tie_embeddings in the model config."
+    )
 
     return model
 
@@ -239,7 +245,12 @@ def _load_inference_model_mlx(
     model_config = ModelConfig(**load_model_config(name=config_name))
     model_config.set_vocab_size(AbsTokenizer().vocab_size)
     model = TransformerLM(model_config)
-    model.load_weights(checkpoint_path, strict=strict)
+    weights = mx.load(checkpoint_path)
+    assert model_config.tie_embeddings or "lm_head.weight" in weights, (
+        "Checkpoint is missing lm_head.weight. If it was trained with tied "
+        "embeddings, set tie_embeddings in the model config."
+    )
+    model.load_weights(list(weights.items()), strict=strict)
     mx.eval(model.parameters())
 
     return model
@@ -3,17 +3,19 @@ import sys
 import csv
 import argparse
 import logging
-import random
 import torch
 import accelerate
 
 from torch import nn as nn
-from torch.utils.data import DataLoader
+from torch.nn import functional as F
+from torch.utils.data import DataLoader, Sampler
 
 from accelerate.logging import get_logger
-from safetensors.torch import load_file
+from safetensors.torch import load_file, save_file
 from logging.handlers import RotatingFileHandler
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from aria.config import load_model_config
@@ -26,6 +28,9 @@ from aria.datasets import (
 from aria.utils import _load_weight
 
 torch._dynamo.config.optimize_ddp = False
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
 
 
 # ----- USAGE -----
@@ -45,6 +50,9 @@ torch._dynamo.config.optimize_ddp = False
 #   --bs 32 \
 #   --workers 8
 #
+# On GPUs that support it, you should also enable bf16 mixed precision by
+# passing --mixed_precision bf16 to accelerate launch.
+#
 # You could resume a run from an accelerate checkpoint with:
 #
 # accelerate launch [arguments] aria/train.py resume \
@@ -155,13 +163,20 @@ def _get_optim(
     warmup: int = 100,
     end_ratio: float = 0.1,
 ):
-    optimizer = torch.optim.AdamW(
-        model.parameters(),
-        lr=lr,
-        weight_decay=0.1,
-        betas=(0.9, 0.95),
-        eps=1e-5,
-    )
+    optim_kwargs = {
+        "lr": lr,
+        "weight_decay": 0.1,
+        "betas": (0.9, 0.95),
+        "eps": 1e-5,
+    }
+    try:
+        # Single kernel update on CUDA
+        optimizer = torch.optim.AdamW(
+            model.parameters(), fused=torch.cuda.is_available(), **optim_kwargs
+        )
+    except RuntimeError:
+        # Older torch versions reject fused=True while params are on the CPU
+        optimizer = torch.optim.AdamW(model.parameters(), **optim_kwargs)
 
     warmup_lrs = torch.optim.lr_scheduler.LinearLR(
         optimizer,
@@ -204,6 +219,27 @@ def get_optim(
     )
 
 
+class FastPermSampler(Sampler[int]):
+    """Shuffles a TrainingDataset using a permutation seeded by its current
+    epoch, so that all processes (and resumed runs) see the same order."""
+
+    def __init__(self, dataset: TrainingDataset, seed: int = 0):
+        self.dataset = dataset
+        self.seed = seed
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(self.seed + self.dataset.curr_epoch)
+        perm = torch.randperm(
+            len(self.dataset), generator=generator, device=self.device
+        )
+        yield from perm.cpu().tolist()
+
+
 def get_dataloaders(
     train_data_dirs: List[str],
     val_data_dir: str,
@@ -213,6 +249,7 @@ def get_dataloaders(
     use_embeddings: bool,
     init_epoch: int | None = None,
     apply_aug: bool = True,
+    pin_memory: bool = True,
 ):
     train_dataset = PretrainingDataset(
         dir_paths=train_data_dirs,
@@ -233,17 +270,24 @@ def get_dataloaders(
     if apply_aug:
         train_dataset.set_transform(tokenizer.export_data_aug())
 
+    # Train workers are not persistent as init_epoch swaps the dataset files
+    # and index in the main process, which live workers would never see
     train_dataloader = DataLoader(
         train_dataset,
         batch_size=batch_size,
         num_workers=num_workers,
-        shuffle=True,
+        sampler=FastPermSampler(train_dataset),
+        pin_memory=pin_memory,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     val_dataloader = DataLoader(
         val_dataset,
         batch_size=batch_size,
         num_workers=num_workers,
         shuffle=False,
+        pin_memory=pin_memory,
+        prefetch_factor=4 if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
     )
 
     if use_embeddings is True:
@@ -255,6 +299,47 @@ def get_dataloaders(
     return train_dataloader, val_dataloader
 
 
+class CUDAPrefetcher:
+    """Copies batches to the device on a side stream, so that the copy isn't
+    queued behind compute already launched on the default stream. Falls back
+    to plain copies off-CUDA."""
+
+    def __init__(self, dataloader: DataLoader, device: torch.device):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.stream = (
+            torch.cuda.Stream(self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        return [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        # Batches are only pulled from the dataloader when requested. Reading
+        # ahead would make accelerate's DataLoaderShard report its end one
+        # step early, so accumulate() would skip the final gradient sync.
+        for batch in self.dataloader:
+            if self.stream is None:
+                yield self._to_device(batch)
+                continue
+
+            with torch.cuda.stream(self.stream):
+                batch = self._to_device(batch)
+
+            curr_stream = torch.cuda.current_stream(self.device)
+            curr_stream.wait_stream(self.stream)
+            for t in batch:
+                # Memory was allocated on the side stream
+                t.record_stream(curr_stream)
+
+            yield batch
+
+
 def _train(
     epochs: int,
     accelerator: accelerate.Accelerator,
@@ -269,10 +354,12 @@ def _train(
     resume_epoch: int | None = None,
     project_dir: str | None = None,
 ):
+    is_main = accelerator.is_main_process
+
     def make_checkpoint(
         _accelerator: accelerate.Accelerator, _epoch: int, _step: int
     ):
-        if accelerator.is_main_process:
+        if is_main:
             checkpoint_dir = os.path.join(
                 project_dir,
                 "checkpoints",
@@ -284,95 +371,186 @@ def _train(
             )
             _accelerator.save_state(checkpoint_dir)
 
+    def save_weights_async(models: list, weights: list, output_dir: str):
+        # Registered as a save_state pre-hook. Model weights are copied to
+        # pinned host memory and written by a background thread, the rest of
+        # the state (optimizer, scheduler, rng) is still saved by accelerate.
+        wait_for_checkpoints()
+
+        cpu_weights = []
+        for idx, state_dict in enumerate(weights):
+            if idx == len(pinned_weights):
+                pinned_weights.append({})
+
+            # Pinned buffers are reused across checkpoints. This is safe as
+            # the previous write was waited on above.
+            cpu_state_dict = {}
+            for k, v in state_dict.items():
+                buff = pinned_weights[idx].get(k)
+                if (
+                    buff is None
+                    or buff.shape != v.shape
+                    or buff.dtype != v.dtype
+                ):
+                    buff = torch.empty(
+                        v.shape,
+                        dtype=v.dtype,
+                        device="cpu",
+                        pin_memory=torch.cuda.is_available(),
+                    )
+                    pinned_weights[idx][k] = buff
+                cpu_state_dict[k] = buff.copy_(v, non_blocking=True)
+            cpu_weights.append(cpu_state_dict)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        for idx, cpu_state_dict in enumerate(cpu_weights):
+            # Same file names as accelerate so that load_state finds them
+            file_name = (
+                "model.safetensors" if idx == 0 else f"model_{idx}.safetensors"
+            )
+            checkpoint_futures.append(
+                checkpoint_executor.submit(
+                    save_file,
+                    cpu_state_dict,
+                    os.path.join(output_dir, file_name),
+                    metadata={"format": "pt"},
+                )
+            )
+
+        # Stop accelerate from also writing the weights synchronously
+        weights.clear()
+
+    def wait_for_checkpoints():
+        while checkpoint_futures:
+            checkpoint_futures.pop(0).result()
+
+    def gather_losses(losses: List[torch.Tensor]):
+        # One gather and host sync for a run of per-step losses
+        gathered = accelerator.gather(torch.stack(losses))
+        return gathered.view(-1, len(losses)).mean(dim=0).tolist()
+
     # This is all slightly messy as train_loop and val_loop make use of the
     # variables in the wider scope. Perhaps refactor this at some point.
     def train_loop(dataloader: DataLoader, _epoch: int, _resume_step: int = 0):
-        loss = torch.tensor([0.0])
         avg_train_loss = 0
         trailing_loss = 0
-        loss_buffer = []
-
-        try:
-            lr_for_print = "{:.2e}".format(scheduler.get_last_lr()[0])
-        except Exception:
-            pass
-        else:
-            lr_for_print = "{:.2e}".format(optimizer.param_groups[-1]["lr"])
+        trailing_sum = 0
+        num_losses = 0
+        loss_buffer = deque(maxlen=TRAILING_LOSS_STEPS)
+        pending_losses = []
+        loss_rows = []
+        num_steps = len(dataloader)
+        # Decide which steps condition on embeddings up front
+        use_emb_flags = (torch.rand(num_steps) > 0.5).tolist()
 
         model.train()
         for __step, batch in (
             pbar := tqdm(
-                enumerate(dataloader),
-                total=len(dataloader) + _resume_step,
+                enumerate(CUDAPrefetcher(dataloader, accelerator.device)),
+                total=num_steps + _resume_step,
                 initial=_resume_step,
                 leave=False,
             )
         ):
-            pbar.set_postfix_str(
-                f"lr={lr_for_print}, "
-                f"loss={round(loss.item(), 4)}, "
-                f"trailing={round(trailing_loss, 4)}"
-            )
-
             with accelerator.accumulate(model):
                 step = __step + _resume_step + 1
                 src, tgt, mask, emb = (
                     batch  # (b_sz, s_len), (b_sz, s_len), (b_sz, s_len), (b_sz, d_emb)
                 )
 
-                use_embeddings_cond = use_embeddings and (random.random() > 0.5)
-
-                if use_embeddings_cond is True:
-                    logits = model(src=src, emb=emb)  # (b_sz, s_len - 1, v_sz)
-                    tgt = tgt[:, :-1]  # (b_sz, s_len - 1)
-                    mask = mask[:, :-1]  # (b_sz, s_len - 1)
-                else:
-                    logits = model(src)  # (b_sz, s_len, v_sz)
-
-                logits = logits.transpose(
-                    1, 2
-                )  # Transpose for CrossEntropyLoss
-                loss = loss_fn(logits, tgt)
-
-                if mask.sum() == 0:
-                    loss = (loss * 0).sum()
-                else:
-                    loss = loss * mask
-                    loss = loss[loss != 0.0].mean()
-
-                # Calculate statistics
-                loss_buffer.append(accelerator.gather(loss).mean(dim=0).item())
-                trailing_loss = sum(loss_buffer[-TRAILING_LOSS_STEPS:]) / len(
-                    loss_buffer[-TRAILING_LOSS_STEPS:]
-                )
-                avg_train_loss = sum(loss_buffer) / len(loss_buffer)
-
-                # Logging
-                logger.debug(
-                    f"EPOCH {_epoch} STEP {step}: "
-                    f"lr={lr_for_print}, "
-                    f"loss={round(loss.item(), 4)}, "
-                    f"trailing_loss={round(trailing_loss, 4)}, "
-                    f"average_loss={round(avg_train_loss, 4)}"
-                )
+                use_embeddings_cond = use_embeddings and use_emb_flags[__step]
+
+                logits = model(
+                    src=src, emb=emb if use_embeddings_cond else None
+                )  # (b_sz, s_len, v_sz), one shorter with emb
+
+                # Align targets to the logits width (no-op without emb)
+                b_sz, s_len, v_sz = logits.shape
+                tgt = tgt[:, :s_len]
+                mask = mask[:, :s_len]
+                loss = F.cross_entropy(
+                    logits.reshape(-1, v_sz),
+                    tgt.reshape(-1),
+                    ignore_index=PAD_ID,
+                    reduction="none",
+                ).view(b_sz, s_len)
 
-                if accelerator.is_main_process:
-                    loss_writer.writerow([_epoch, step, loss.item()])
+                # Masked mean without a host sync (0 if the mask is empty)
+                loss = (loss * mask).sum() / mask.sum().clamp_min(1)
+                pending_losses.append(loss.detach())
 
                 accelerator.backward(loss)
                 optimizer.step()
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 if scheduler:
                     scheduler.step()
-                    lr_for_print = "{:.2e}".format(scheduler.get_last_lr()[0])
-
-                if steps_per_checkpoint:
-                    if step % steps_per_checkpoint == 0:
-                        make_checkpoint(
-                            _accelerator=accelerator,
-                            _epoch=_epoch,
-                            _step=step,
+
+                # Calculate statistics (only syncs with host every few steps)
+                last_step = __step + 1 == num_steps
+                # Rows up to a checkpoint are written before it is saved
+                checkpoint_step = bool(steps_per_checkpoint) and (
+                    step % steps_per_checkpoint == 0
+                )
+                if (
+                    len(pending_losses) == LOSS_LOG_STEPS
+                    or last_step
+                    or checkpoint_step
+                ):
+                    step_losses = gather_losses(pending_losses)
+                    pending_losses = []
+                    for _loss in step_losses:
+                        if len(loss_buffer) == TRAILING_LOSS_STEPS:
+                            trailing_sum -= loss_buffer[0]
+                        loss_buffer.append(_loss)
+                        trailing_sum += _loss
+                        num_losses += 1
+                        avg_train_loss += (_loss - avg_train_loss) / num_losses
+                    trailing_loss = trailing_sum / len(loss_buffer)
+
+                    # Logging
+                    lr_for_print = "{:.2e}".format(
+                        optimizer.param_groups[0]["lr"]
+                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "EPOCH %d STEP %d: lr=%s, loss=%.4f, "
+                            "trailing_loss=%.4f, average_loss=%.4f",
+                            _epoch,
+                            step,
+                            lr_for_print,
+                            step_losses[-1],
+                            trailing_loss,
+                            avg_train_loss,
                         )
+                    pbar.set_postfix_str(
+                        f"lr={lr_for_print}, "
+                        f"loss={round(step_losses[-1], 4)}, "
+                        f"trailing={round(trailing_loss, 4)}"
+                    )
+
+                    if is_main:
+                        first_step = step - len(step_losses) + 1
+                        loss_rows.extend(
+                            [_epoch, first_step + idx, _loss]
+                            for idx, _loss in enumerate(step_losses)
+                        )
+                        if (
+                            len(loss_rows) >= LOSS_CSV_FLUSH_STEPS
+                            or last_step
+                            or checkpoint_step
+                        ):
+                            loss_writer.writerows(loss_rows)
+                            loss_csv.flush()
+                            loss_rows = []
+
+                if checkpoint_step:
+                    make_checkpoint(
+                        _accelerator=accelerator,
+                        _epoch=_epoch,
+                        _step=step,
+                    )
 
         logger.info(
             f"EPOCH {_epoch}/{epochs + start_epoch}: Finished training - "
@@ -383,40 +561,51 @@ def _train(
 
     @torch.no_grad()
     def val_loop(dataloader, _epoch: int):
-        loss_buffer = []
+        avg_val_loss = 0
+        num_losses = 0
+        pending_losses = []
+        num_steps = len(dataloader)
+        use_emb_flags = (torch.rand(num_steps) > 0.5).tolist()
         model.eval()
         for step, batch in (
             pbar := tqdm(
-                enumerate(dataloader),
-                total=len(dataloader),
+                enumerate(CUDAPrefetcher(dataloader, accelerator.device)),
+                total=num_steps,
                 leave=False,
             )
         ):
             src, tgt, mask, emb = (
                 batch  # (b_sz, s_len), (b_sz, s_len), (b_sz, s_len), (b_sz, d_emb)
             )
-            use_embeddings_cond = use_embeddings and (random.random() > 0.5)
+            use_embeddings_cond = use_embeddings and use_emb_flags[step]
 
-            if use_embeddings_cond is True:
-                logits = model(src=src, emb=emb)  # (b_sz, s_len - 1, v_sz)
-                tgt = tgt[:, :-1]  # (b_sz, s_len - 1)
-                mask = mask[:, :-1]  # (b_sz, s_len - 1)
-            else:
-                logits = model(src)  # (b_sz, s_len, v_sz)
+            logits = model(
+                src=src, emb=emb if use_embeddings_cond else None
+            )  # (b_sz, s_len, v_sz), one shorter with emb
 
-            logits = logits.transpose(1, 2)  # Transpose for CrossEntropyLoss
-            loss = loss_fn(logits, tgt)
+            # Align targets to the logits width (no-op without emb)
+            b_sz, s_len, v_sz = logits.shape
+            tgt = tgt[:, :s_len]
+            mask = mask[:, :s_len]
+            loss = F.cross_entropy(
+                logits.reshape(-1, v_sz),
+                tgt.reshape(-1),
+                ignore_index=PAD_ID,
+                reduction="none",
+            ).view(b_sz, s_len)
 
-            if mask.sum() == 0:
-                loss = (loss * 0).sum()
-            else:
-                loss = loss * mask
-                loss = loss[loss != 0.0].mean()
+            # Masked mean without a host sync (0 if the mask is empty)
+            loss = (loss * mask).sum() / mask.sum().clamp_min(1)
+
+            pending_losses.append(loss)
 
             # Logging
-            loss_buffer.append(accelerator.gather(loss).mean(dim=0).item())
-            avg_val_loss = sum(loss_buffer) / len(loss_buffer)
-            pbar.set_postfix_str(f"average_loss={round(avg_val_loss, 4)}")
+            if len(pending_losses) == LOSS_LOG_STEPS or step + 1 == num_steps:
+                for _loss in gather_losses(pending_losses):
+                    num_losses += 1
+                    avg_val_loss += (_loss - avg_val_loss) / num_losses
+                pending_losses = []
+                pbar.set_postfix_str(f"average_loss={round(avg_val_loss, 4)}")
 
         # EPOCH
         logger.info(
@@ -432,17 +621,23 @@ def _train(
         )
 
     TRAILING_LOSS_STEPS = 200
+    LOSS_LOG_STEPS = 10
+    LOSS_CSV_FLUSH_STEPS = 64
     PAD_ID = train_dataloader.dataset.tokenizer.pad_id
     logger = get_logger(__name__)  # Accelerate logger
-    loss_fn = nn.CrossEntropyLoss(ignore_index=PAD_ID, reduction="none")
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint_futures = []
+    pinned_weights = []
+    accelerator.register_save_state_pre_hook(save_weights_async)
 
-    logger.info(
-        f"Model has "
-        f"{'{:,}'.format(sum(p.numel() for p in model.parameters() if p.requires_grad))} "
-        "parameters"
-    )
+    if is_main:
+        logger.info(
+            f"Model has "
+            f"{'{:,}'.format(sum(p.numel() for p in model.parameters() if p.requires_grad))} "
+            "parameters"
+        )
 
-    if accelerator.is_main_process:
+    if is_main:
         loss_csv = open(os.path.join(project_dir, "loss.csv"), "w")
         loss_writer = csv.writer(loss_csv)
         loss_writer.writerow(["epoch", "step", "loss"])
@@ -471,7 +666,7 @@ def _train(
             _resume_step=resume_step,
         )
         avg_val_loss = val_loop(dataloader=val_dataloader, _epoch=resume_epoch)
-        if accelerator.is_main_process:
+        if is_main:
             epoch_writer.writerow([resume_epoch, avg_train_loss, avg_val_loss])
             epoch_csv.flush()
             make_checkpoint(
@@ -482,13 +677,16 @@ def _train(
         train_dataloader.dataset.init_epoch(epoch)
         avg_train_loss = train_loop(dataloader=train_dataloader, _epoch=epoch)
         avg_val_loss = val_loop(dataloader=val_dataloader, _epoch=epoch)
-        if accelerator.is_main_process:
+        wait_for_checkpoints()
+        if is_main:
             epoch_writer.writerow([epoch, avg_train_loss, avg_val_loss])
             epoch_csv.flush()
             make_checkpoint(_accelerator=accelerator, _epoch=epoch + 1, _step=0)
 
+    wait_for_checkpoints()
+    checkpoint_executor.shutdown()
     logging.shutdown()
-    if accelerator.is_main_process:
+    if is_main:
         loss_csv.close()
         epoch_csv.close()
 
@@ -530,7 +728,14 @@ def resume_train(
         raise Exception("Invalid tokenizer name")
 
     accelerator = accelerate.Accelerator(
-        project_dir=project_dir, gradient_accumulation_steps=grad_acc_steps
+        project_dir=project_dir,
+        gradient_accumulation_steps=grad_acc_steps,
+        kwargs_handlers=[
+            # TransformerLM_CND only uses embedding_adapter on some steps
+            accelerate.DistributedDataParallelKwargs(
+                find_unused_parameters=use_embeddings
+            )
+        ],
     )
     if accelerator.is_main_process:
         project_dir = setup_project_dir(project_dir)
@@ -561,6 +766,11 @@ def resume_train(
 
     if steps_per_checkpoint:
         logger.info(f"Creating checkpoints every {steps_per_checkpoint}")
+    if accelerator.mixed_precision == "no" and torch.cuda.is_bf16_supported():
+        logger.warning(
+            "Mixed precision is disabled, consider launching with "
+            "--mixed_precision bf16"
+        )
 
     # Init model
     model_config = ModelConfig(**load_model_config(model_name))
@@ -571,7 +781,8 @@ def resume_train(
     else:
         model = TransformerLM(model_config)
 
-    model.compile()
+    # CUDA graphs (reduce-overhead) need static shapes and no graph breaks
+    model.compile(mode="reduce-overhead", fullgraph=True, dynamic=False)
 
     train_dataloader, val_dataloader = get_dataloaders(
         train_data_dirs=train_data_paths,
@@ -589,18 +800,15 @@ def resume_train(
         steps_per_epoch=len(train_dataloader) // grad_acc_steps,
     )
 
-    (
-        model,
-        train_dataloader,
-        val_dataloader,
-        optimizer,
-        scheduler,
-    ) = accelerator.prepare(
-        model,
-        train_dataloader,
-        val_dataloader,
-        optimizer,
-        scheduler,
+    model, optimizer, scheduler = accelerator.prepare(
+        model, optimizer, scheduler
+    )
+    # Batches are moved to the device by CUDAPrefetcher inside _train
+    train_dataloader = accelerator.prepare_data_loader(
+        train_dataloader, device_placement=False
+    )
+    val_dataloader = accelerator.prepare_data_loader(
+        val_dataloader, device_placement=False
     )
 
     try:
@@ -663,7 +871,14 @@ def train(
         raise Exception("Invalid tokenizer name")
 
     accelerator = accelerate.Accelerator(
-        project_dir=project_dir, gradient_accumulation_steps=grad_acc_steps
+        project_dir=project_dir,
+        gradient_accumulation_steps=grad_acc_steps,
+        kwargs_handlers=[
+            # TransformerLM_CND only uses embedding_adapter on some steps
+            accelerate.DistributedDataParallelKwargs(
+                find_unused_parameters=use_embeddings
+            )
+        ],
     )
     if accelerator.is_main_process:
         project_dir = setup_project_dir(project_dir)
@@ -686,6 +901,11 @@ def train(
 
     if steps_per_checkpoint:
         logger.info(f"Creating checkpoints every {steps_per_checkpoint}")
+    if accelerator.mixed_precision == "no" and torch.cuda.is_bf16_supported():
+        logger.warning(
+            "Mixed precision is disabled, consider launching with "
+            "--mixed_precision bf16"
+        )
 
     # Init model
     model_config = ModelConfig(**load_model_config(model_name))
@@ -696,7 +916,8 @@ def train(
     else:
         model = TransformerLM(model_config)
 
-    model.compile()
+    # CUDA graphs (reduce-overhead) need static shapes and no graph breaks
+    model.compile(mode="reduce-overhead", fullgraph=True, dynamic=False)
     logger.info(f"Loaded model with config: {load_model_config(model_name)}")
     if checkpoint_path:
         try:
@@ -734,18 +955,15 @@ def train(
         steps_per_epoch=len(train_dataloader) // grad_acc_steps,
     )
 
-    (
-        model,
-        train_dataloader,
-        val_dataloader,
-        optimizer,
-        scheduler,
-    ) = accelerator.prepare(
-        model,
-        train_dataloader,
-        val_dataloader,
-        optimizer,
-        scheduler,
+    model, optimizer, scheduler = accelerator.prepare(
+        model, optimizer, scheduler
+    )
+    # Batches are moved to the device by CUDAPrefetcher inside _train
+    train_dataloader = accelerator.prepare_data_loader(
+        train_dataloader, device_placement=False
+    )
+    val_dataloader = accelerator.prepare_data_loader(
+        val_dataloader, device_placement=False
     )
 
     logger.info(f"Starting {'finetune' if checkpoint_path else 'pretrain'} job")
@@ -391,6 +391,11 @@ def load_model(checkpoint_path: str):
         f"weights={weights['model.tok_embeddings.weight'].shape[0]}"
     )
 
+    assert model_config.tie_embeddings or "lm_head.weight" in weights, (
+        "Checkpoint is missing lm_head.weight. If it was trained with tied "
+        "embeddings, set tie_embeddings in the model config."
+    )
+
     model.load_weights(list(weights.items()), strict=False)
     model.eval()
 